@@ -2,9 +2,17 @@
 
 import sys
 import os
-from typing import Optional, Any, List, Iterable
-from struct import unpack, pack, calcsize
+import stat
+from typing import Optional, Any, List, Dict, Set, Tuple
+from struct import Struct, unpack, calcsize
 from shutil import copyfile
+from hashlib import blake2b
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+  from fcntl import ioctl
+except ImportError:
+  ioctl = None
 
 
 HELP = '''
@@ -12,7 +20,8 @@ Optimize the file dump for checkpoints.
 
 This script will copy the source files that specified in the kfd dumps
 to the parent directory of the checkpoint directory, and keep only one
-copy of the files referenced by multiple kfd dumps.
+copy of the files referenced by multiple kfd dumps, or of the files that
+have the same content.
 
 You should use the option `--dump-after-open` to generate checkpoints
 without using `--dump-file`.
@@ -26,6 +35,17 @@ O_RDONLY = 0o0000
 O_WRONLY = 0o0001
 O_RDWR = 0o0002
 
+# `FICLONE` request of `ioctl`, see `ioctl_ficlone(2)`
+FICLONE = 0x40049409
+
+DIGEST_CHUNK_SIZE = 1 << 20
+COPY_CHUNK_SIZE = 1 << 30
+COPY_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+COPY_WORKERS_PER_DEVICE = 4
+
+KFD_HEADER = {'<': Struct('<QII'), '>': Struct('>QII')}
+KFD_READ_SIZE = 4096
+
 
 class PlatInfo:
   '''
@@ -34,6 +54,8 @@ class PlatInfo:
 
   def __init__(self) -> None:
     self.endian: Optional[str] = None
+    # (device, inode) of the checked files
+    self.__checked: Set[Tuple[int, int]] = set()
 
   def __check_field(self, field_name: str, value: Any, file: str) -> None:
     field = getattr(self, field_name)
@@ -46,11 +68,20 @@ class PlatInfo:
     '''
     Checks (or initializes) the data of `platinfo`.
     '''
-    with open(file, 'rb') as f:
-      magic, endian = unpack('<2sc', f.read(calcsize('<2sc')))
-      if magic != b'pi':
-        raise RuntimeError(f'"{file}" is not a valid platinfo file')
-      self.__check_field('endian', '<' if endian == b'\x00' else '>', file)
+    fd = os.open(file, os.O_RDONLY)
+    try:
+      # skip the files that have been checked, e.g. hard links
+      st = os.fstat(fd)
+      inode = (st.st_dev, st.st_ino)
+      if inode in self.__checked:
+        return
+      magic, endian = unpack('<2sc', os.read(fd, calcsize('<2sc')))
+    finally:
+      os.close(fd)
+    if magic != b'pi':
+      raise RuntimeError(f'"{file}" is not a valid platinfo file')
+    self.__check_field('endian', '<' if endian == b'\x00' else '>', file)
+    self.__checked.add(inode)
 
 
 class KfdDump:
@@ -60,114 +91,281 @@ class KfdDump:
 
   def __init__(self, platinfo: PlatInfo, file: str) -> None:
     self.file = file
-    self.fmt = f'{platinfo.endian}QII'
-    fmt_len = calcsize(self.fmt)
-    with open(file, 'rb') as f:
-      self.offset, self.flags, path_len = unpack(self.fmt, f.read(fmt_len))
-      self.path = f.read(path_len).decode('ascii')
+    # the file is `<checkpoint_dir>/file/kfd/<name>`
+    kfd_dir, self.name = os.path.split(file)
+    self.checkpoint_dir = os.path.dirname(os.path.dirname(kfd_dir))
+    self.header = KFD_HEADER[platinfo.endian]
+    header_len = self.header.size
+    # read the header and the path with a single `read` in most cases
+    fd = os.open(file, os.O_RDONLY)
+    try:
+      buf = os.read(fd, KFD_READ_SIZE)
+      self.offset, self.flags, path_len = self.header.unpack_from(buf)
+      path = buf[header_len:header_len + path_len]
+      if len(path) < path_len:
+        path += os.read(fd, path_len - len(path))
+    finally:
+      os.close(fd)
+    # the path is kept as raw bytes, it is only used as a file name
+    self.path = path
+    self.accmode = self.flags & O_ACCMODE
 
   def update(self) -> None:
     '''
     Updates the data of the kfd dump.
     '''
-    with open(self.file, 'wb') as f:
-      f.write(pack(self.fmt, self.offset, self.flags, len(self.path)))
-      f.write(self.path.encode('ascii'))
+    header = self.header.pack(self.offset, self.flags, len(self.path))
+    fd = os.open(self.file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+      os.writev(fd, (header, self.path))
+    finally:
+      os.close(fd)
 
   def read_only(self) -> bool:
     '''
     Returns whether the kfd is read-only.
     '''
-    return self.flags & O_ACCMODE == O_RDONLY
+    return self.accmode == O_RDONLY
 
   def write_only(self) -> bool:
     '''
     Returns whether the kfd is write-only.
     '''
-    return self.flags & O_ACCMODE == O_WRONLY
+    return self.accmode == O_WRONLY
 
   def read_write(self) -> bool:
     '''
     Returns whether the kfd is read-write.
     '''
-    return self.flags & O_ACCMODE == O_RDWR
+    return self.accmode == O_RDWR
 
   def is_abs_path(self) -> bool:
     '''
     Returns whether the path is an absolute path.
     '''
-    return self.path[0] == '/'
+    return self.path[:1] == b'/'
 
 
-def scan_kfd_dumps(checkpoint_dir: str, platinfo: PlatInfo) -> Iterable[KfdDump]:
+def scan_kfd_dumps(checkpoint_dir: str, platinfo: PlatInfo) -> List[KfdDump]:
   '''
   Scans the kfd dumps of a checkpoint.
 
-  Returns an iterator of `KfdDump` objects.
+  Returns a list of `KfdDump` objects.
   '''
   kfd_dir = os.path.join(checkpoint_dir, 'file', 'kfd')
-  kfd_files = [f for f in os.listdir(kfd_dir) if f.isnumeric()]
-  return map(lambda f: KfdDump(platinfo, os.path.join(kfd_dir, f)), kfd_files)
+  with os.scandir(kfd_dir) as it:
+    return [KfdDump(platinfo, e.path) for e in it if e.name.isdigit()]
 
 
-def collect_kfd_dumps(parent_dir: str) -> Iterable[KfdDump]:
+def collect_kfd_dumps(parent_dir: str) -> List[KfdDump]:
   '''
   Collects the kfd dumps in all checkpoints.
 
-  Returns an iterator of `KfdDump` objects.
+  Returns a list of `KfdDump` objects.
   '''
+  kfds: List[KfdDump] = []
   platinfo = PlatInfo()
   # for each checkpoint directory
-  for f in os.listdir(parent_dir):
-    checkpoint_dir = os.path.join(parent_dir, f)
-    if not os.path.isdir(checkpoint_dir):
-      continue
+  with os.scandir(parent_dir) as it:
+    checkpoint_dirs = [e.path for e in it if e.is_dir()]
+  for checkpoint_dir in checkpoint_dirs:
     # check the platinfo file
     platinfo.check(os.path.join(checkpoint_dir, 'platinfo'))
     # for each kfd dumps
-    for kfd in scan_kfd_dumps(checkpoint_dir, platinfo):
-      if kfd.is_abs_path():
-        yield kfd
+    kfds += [kfd for kfd in scan_kfd_dumps(checkpoint_dir, platinfo)
+             if kfd.is_abs_path()]
+  return kfds
 
 
-def get_native_path(kfd: KfdDump, path: str) -> str:
+def get_native_path(kfd: KfdDump, path: bytes) -> bytes:
   '''
   Returns a path that applies to the native OS of the given kfd and path.
   '''
-  split_kfd_path = kfd.file.split('/')
-  assert split_kfd_path[-3] == 'file' and split_kfd_path[-2] == 'kfd'
-  p = os.path.join(*split_kfd_path[:-3], *path.split('/'))
-  if kfd.file.startswith('/'):
-    p = os.path.sep + p
-  return p
+  if os.path.sep != '/':
+    path = path.replace(b'/', os.fsencode(os.path.sep))
+  return os.path.join(os.fsencode(kfd.checkpoint_dir), path)
+
+
+def clone_file(src: bytes, dst: bytes, st: os.stat_result) -> None:
+  '''
+  Copies file `src` to `dst`, shares the data blocks between them
+  if the file system supports reflinks, otherwise copies the data
+  inside the kernel if possible.
+
+  `st` is the result of `os.stat(src)`.
+  '''
+  # leave special files (e.g. named pipes) to `copyfile`,
+  # which rejects them instead of blocking on `open`
+  if stat.S_ISREG(st.st_mode):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+      src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+      if ioctl is not None:
+        try:
+          ioctl(dst_fd, FICLONE, src_fd)
+          return
+        except OSError:
+          pass
+      if hasattr(os, 'copy_file_range'):
+        copied = 0
+        try:
+          while n := os.copy_file_range(src_fd, dst_fd, COPY_CHUNK_SIZE):
+            copied += n
+        except OSError:
+          # errors in the middle of a copy are real errors
+          if copied:
+            raise
+        # copying nothing may also mean that `copy_file_range` is not
+        # supported, e.g. for procfs or sysfs files on some kernels
+        if copied:
+          return
+  copyfile(src, dst, follow_symlinks=True)
+
+
+def file_digest(path: bytes) -> bytes:
+  '''
+  Returns the digest of the content of the given regular file.
+  '''
+  h = blake2b(digest_size=16)
+  with open(path, 'rb') as f:
+    while chunk := f.read(DIGEST_CHUNK_SIZE):
+      h.update(chunk)
+  return h.digest()
+
+
+class CopiedFiles:
+  '''
+  Copied files, deduplicated by their content.
+
+  Paths that refer to the same inode are matched directly. Otherwise
+  regular files are compared by size first, the digest of a file is only
+  computed if there is another file with the same size.
+  '''
+
+  def __init__(self) -> None:
+    # source path -> copied path
+    self.__paths: Dict[bytes, bytes] = {}
+    # (device, inode) -> copied path
+    self.__inodes: Dict[Tuple[int, int], bytes] = {}
+    # size -> source path that has not been digested yet, or `None`
+    self.__sizes: Dict[int, Optional[bytes]] = {}
+    # (size, digest) -> copied path
+    self.__digests: Dict[Tuple[int, bytes], bytes] = {}
+    self.__count = 0
+
+  def __len__(self) -> int:
+    return self.__count
+
+  def __add_digest(self, path: bytes, size: int) -> bytes:
+    key = (size, file_digest(path))
+    return self.__digests.setdefault(key, self.__paths[path])
+
+  def get(self, path: bytes) -> Optional[bytes]:
+    '''
+    Returns the copied path of file `path` if it has been added.
+    '''
+    return self.__paths.get(path)
+
+  def add(self, path: bytes, new_path: bytes, st: os.stat_result) -> bytes:
+    '''
+    Adds file `path` which will be copied to `new_path`,
+    `st` is the result of `os.stat(path)`.
+
+    Returns the path of the existing copy if a file with the same
+    content has been added, otherwise returns `new_path`.
+    '''
+    inode = (st.st_dev, st.st_ino)
+    copied = self.__inodes.get(inode)
+    if copied is not None:
+      self.__paths[path] = copied
+      return copied
+    self.__paths[path] = new_path
+    size = st.st_size
+    # special files are never deduplicated, nor digested
+    if stat.S_ISREG(st.st_mode) and size not in self.__sizes:
+      self.__sizes[size] = path
+    elif stat.S_ISREG(st.st_mode):
+      # digest the pending file with the same size first
+      pending = self.__sizes[size]
+      if pending is not None:
+        self.__add_digest(pending, size)
+        self.__sizes[size] = None
+      self.__paths[path] = self.__add_digest(path, size)
+    copied = self.__paths[path]
+    self.__inodes[inode] = copied
+    if copied == new_path:
+      self.__count += 1
+    return copied
+
+
+Copy = Tuple[os.stat_result, bytes, bytes]
+
+
+def clone_serially(group: List[Copy]) -> None:
+  '''
+  Clones files in the given group one by one.
+  '''
+  for st, src, dst in group:
+    clone_file(src, dst, st)
+
+
+def clone_files(copies: List[Copy]) -> None:
+  '''
+  Clones files, `copies` is a list of the stat of the source,
+  the source and the destination.
+
+  Copies are grouped by the device of the source files, and each device
+  is copied by at most `COPY_WORKERS_PER_DEVICE` workers, so the devices
+  are copied concurrently without too much contention on each of them.
+  '''
+  groups: Dict[int, List[Copy]] = {}
+  for copy in copies:
+    groups.setdefault(copy[0].st_dev, []).append(copy)
+  # split each group into serial tasks, interleaved across devices
+  tasks = [group[i::COPY_WORKERS_PER_DEVICE]
+           for i in range(COPY_WORKERS_PER_DEVICE)
+           for group in groups.values()]
+  tasks = [task for task in tasks if task]
+  if not tasks:
+    return
+  with ThreadPoolExecutor(min(len(tasks), COPY_WORKERS)) as executor:
+    for _ in executor.map(clone_serially, tasks):
+      pass
 
 
 def copy_files(parent_dir: str) -> None:
   '''
   Copy files to parent/checkpoint directory.
   '''
-  copied_files = {}
-  kfds: List[KfdDump] = []
-  # for each kfd object, copy the associated file to directory
-  for kfd in collect_kfd_dumps(parent_dir):
-    if kfd.read_only():
-      id = copied_files.get(kfd.path, len(copied_files))
-      new_path = f'../{kfd.path.split("/")[-1]}.{id}'
-      if kfd.path not in copied_files:
-        copyfile(kfd.path, get_native_path(kfd, new_path), follow_symlinks=True)
-        copied_files[kfd.path] = id
-      kfd.path = new_path
+  copied_files = CopiedFiles()
+  kfds = collect_kfd_dumps(parent_dir)
+  # files to be copied
+  copies: List[Copy] = []
+  # for each kfd object, decide where the associated file goes
+  for kfd in kfds:
+    accmode = kfd.accmode
+    if accmode == O_RDONLY:
+      copied_path = copied_files.get(kfd.path)
+      if copied_path is None:
+        st = os.stat(kfd.path)
+        new_path = b'../%s.%d' % (kfd.path.rpartition(b'/')[2],
+                                  len(copied_files))
+        copied_path = copied_files.add(kfd.path, new_path, st)
+        if copied_path == new_path:
+          copies.append((st, kfd.path, get_native_path(kfd, new_path)))
+      kfd.path = copied_path
     else:
-      new_path = f'file/kfd/{kfd.path.split("/")[-1]}.{kfd.file.split("/")[-1]}'
+      new_path = b'file/kfd/%s.%s' % (kfd.path.rpartition(b'/')[2],
+                                      os.fsencode(kfd.name))
       native_path = get_native_path(kfd, new_path)
-      if kfd.write_only():
+      if accmode == O_WRONLY:
         open(native_path, 'w').close()
-      elif kfd.read_write():
-        copyfile(kfd.path, native_path, follow_symlinks=True)
+      elif accmode == O_RDWR:
+        copies.append((os.stat(kfd.path), kfd.path, native_path))
       else:
         raise RuntimeError(f'unknown kfd type in "{kfd.file}"')
       kfd.path = new_path
-    kfds.append(kfd)
+  # copy files
+  clone_files(copies)
   # update kfds
   for kfd in kfds:
     kfd.update()
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
 import sys
+import os
+import mmap
 import struct
+from typing import Any, Callable, List, Optional, Tuple
 
 
 HELP = '''
@@ -11,9 +14,11 @@ System call trace viewer.
 '''.strip()
 
 
-STRUCT_FMT = '<7QQ'
+# `epc` is kept as raw bytes, which is faster to print in hex
+STRUCT_FMT = '<7Q8s'
 STRUCT_LEN = struct.calcsize(STRUCT_FMT)
-unpack = struct.Struct(STRUCT_FMT).unpack_from
+OUTPUT_BATCH = 4096
+iter_unpack = struct.Struct(STRUCT_FMT).iter_unpack
 
 
 def fmt_i32(i: int) -> str:
@@ -107,17 +112,41 @@ SYS_TABLE = {
 }
 
 
-def print_syscall(data: bytes) -> None:
-  a0, a1, a2, a3, a4, a5, n, epc = unpack(data)
-  args = (a0, a1, a2, a3, a4, a5)
-  if n in SYS_TABLE:
-    name = SYS_TABLE[n][0]
-    args_str = ', '.join(
-        map(lambda x: x[0](x[1]), zip(SYS_TABLE[n][1:], args)))
-  else:
-    name = '<UNKNOWN>'
-    args_str = ''
-  print(f'{i:06d}: epc={epc:016x}, {name}({args_str})')
+# f-string fields equivalent to the argument formatters,
+# `%s` will be replaced by the argument expression
+INLINE_FMT = {
+    fmt_i32: '{((%s & 0xffffffff) ^ 0x80000000) - 0x80000000}',
+    fmt_u32: '{%s & 0xffffffff}',
+    fmt_ptr: '0x{%s:x}',
+    fmt_size: '{%s}',
+    fmt_off: '{(%s ^ 0x8000000000000000) - 0x8000000000000000}',
+}
+
+Formatter = Callable[[Tuple[Any, ...]], str]
+
+
+def gen_formatter(name: str, *fmts: Callable[[int], str]) -> Formatter:
+  '''
+  Generates a function that formats a system call record,
+  with the argument formatters unrolled and inlined.
+  '''
+  args = ', '.join(
+      INLINE_FMT[f] % f'r[{i}]' if f in INLINE_FMT else
+      f'{{f{i}(r[{i}])}}' for i, f in enumerate(fmts))
+  return eval(f"lambda r: f'{name}({args})'",
+              {f'f{i}': f for i, f in enumerate(fmts)})
+
+
+SYS_DISPATCH: List[Optional[Formatter]] = [None] * (max(SYS_TABLE) + 1)
+for n, (name, *fmts) in SYS_TABLE.items():
+  SYS_DISPATCH[n] = gen_formatter(name, *fmts)
+
+
+def format_syscall(i: int, r: Tuple[Any, ...]) -> str:
+  n = r[6]
+  fmt = SYS_DISPATCH[n] if n < len(SYS_DISPATCH) else None
+  call = fmt(r) if fmt else '<UNKNOWN>()'
+  return f'{i:06d}: epc={r[7][::-1].hex()}, {call}\n'
 
 
 if __name__ == '__main__':
@@ -127,7 +156,21 @@ if __name__ == '__main__':
 
   st_file = sys.argv[1]
   with open(st_file, 'rb') as f:
-    i = 0
-    while data := f.read(STRUCT_LEN):
-      print_syscall(data)
-      i += 1
+    # `mmap` does not accept empty files
+    if os.fstat(f.fileno()).st_size:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        # `iter_unpack` only accepts complete records, the trace
+        # may end with a partial record if the program was killed
+        end = len(mm) - len(mm) % STRUCT_LEN
+        with memoryview(mm) as view, view[:end] as records:
+          # write the output in batches of lines
+          lines: List[str] = []
+          for i, r in enumerate(iter_unpack(records)):
+            lines.append(format_syscall(i, r))
+            if len(lines) == OUTPUT_BATCH:
+              sys.stdout.write(''.join(lines))
+              lines.clear()
+          sys.stdout.write(''.join(lines))
+        if end != len(mm):
+          sys.stdout.flush()
+          sys.exit(f'error: truncated record at offset {end} of "{st_file}"')